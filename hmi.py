@@ -1,15 +1,38 @@
-from flask import Flask, request, redirect, jsonify, render_template_string
-import json, os, time
+from flask import Flask, Response, request, redirect, render_template_string, stream_with_context
+import json, os, time, threading
 from pathlib import Path
+import yaml
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    # chạy dưới gevent: sleep trong /events phải nhường cho greenlet khác
+    from gevent import sleep as _sleep
+except ImportError:
+    _sleep = time.sleep
+
+from shm import open_region
 
 APP = Flask(__name__)
 
-# Thư mục chung với piplc.py
-BASE = Path.home() / "~/piplc_template/piplc"
+# Thư mục chung với piplc.py: cạnh hmi.py, hoặc PIPLC_BASE (phải giống bên piplc.py)
+BASE = Path(os.environ.get("PIPLC_BASE", Path(__file__).resolve().parent)).resolve()
 BASE.mkdir(parents=True, exist_ok=True)
 
 CMD_FILE   = BASE / "hmi_cmd.json"
 STATE_FILE = BASE / "runtime_state.json"
+CFG_FILE   = BASE / "config.yaml"
+
+# IPC với piplc.py qua /dev/shm; máy không có /dev/shm thì dùng 2 file JSON ở trên.
+# Có /dev/shm mà không mở được (sai group...) → raise, không chạy lệch kênh với PLC
+SHM = open_region()
+if SHM is None:
+    APP.logger.warning("no /dev/shm; using JSON files for IPC")
+
+# /events: chu kỳ kiểm tra state mới (phía server) và keepalive cho proxy/browser
+EVENT_POLL_S = 0.1
+EVENT_KEEPALIVE_S = 15
 
 TEMPLATE = """
 <!doctype html>
@@ -43,40 +66,56 @@ TEMPLATE = """
 
 <div class="card">
   <div class="stat">Trạng thái: <span id="mode" class="big">—</span></div>
-  <div class="stat">Đã gắp: <span id="total" class="big">0</span></div>
-  <div class="stat">Trong batch hiện tại: <span id="batch" class="big">0</span> / <span id="batchsize">10</span></div>
-  <div class="stat">Target tổng: <span id="target" class="big">0</span></div>
+  <div class="stat">Đã gắp: <span id="total_done" class="big">0</span></div>
+  <div class="stat">Trong batch hiện tại: <span id="batch_count" class="big">0</span> / <span id="batch_size">10</span></div>
+  <div class="stat">Target tổng: <span id="target_n" class="big">0</span></div>
   <div class="stat" id="error" class="warn"></div>
 </div>
 
 <script>
+// id của element = tên field trong state → vá đúng những field có trong js
+function render(js){
+  for(const [k, v] of Object.entries(js)){
+    if(k === 'error'){
+      const errEl = document.getElementById('error');
+      errEl.textContent = v ? 'Error: ' + v : '';
+      errEl.className = v ? 'stat warn' : 'stat';
+    }else{
+      const el = document.getElementById(k);
+      if(el) el.textContent = v;
+    }
+  }
+}
 async function pull(){
   try{
     const r = await fetch('/state');
-    const js = await r.json();
-    document.getElementById('mode').textContent   = js.mode ?? '—';
-    document.getElementById('total').textContent  = js.total_done ?? 0;
-    document.getElementById('batch').textContent  = js.batch_count ?? 0;
-    document.getElementById('target').textContent = js.target_n ?? 0;
-    document.getElementById('batchsize').textContent = js.batch_size ?? 10;
-
-    const errEl = document.getElementById('error');
-    if(js.error){ errEl.textContent = 'Error: ' + js.error; errEl.className='stat warn'; }
-    else { errEl.textContent = ''; errEl.className='stat'; }
+    render(await r.json());
   }catch(e){
     console.log('pull state failed', e);
   }finally{
     setTimeout(pull, 1000); // refresh mỗi 1s
   }
 }
-pull();
+if(window.EventSource){
+  // PLC đẩy state qua SSE: lần đầu đủ field, sau đó chỉ field đã đổi; EventSource tự reconnect
+  new EventSource('/events').onmessage = e => render(JSON.parse(e.data));
+}else{
+  pull();
+}
 </script>
 """
 
+# dev server threaded / gevent: nhiều POST cùng lúc → seqlock CmdBlk chỉ được một writer
+_cmd_lock = threading.Lock()
+
 def write_cmd(d):
+    if SHM is not None:
+        with _cmd_lock:
+            SHM.write_cmd(d)
+        return
     d["ts"] = time.time()
-    with open(CMD_FILE, "w") as f:
-        json.dump(d, f)
+    with open(CMD_FILE, "wb") as f:
+        f.write(json_dumps(d))
 
 @APP.route("/", methods=["GET","POST"])
 def home():
@@ -97,27 +136,112 @@ def home():
         return redirect("/")
     return render_template_string(TEMPLATE)
 
-@APP.route("/state")
-def state():
-    # Trả JSON cho JS đọc định kỳ
+def json_dumps(d) -> bytes:
+    return orjson.dumps(d) if orjson is not None else json.dumps(d).encode()
+
+def json_loads(b: bytes):
+    return orjson.loads(b) if orjson is not None else json.loads(b)
+
+# config.yaml chỉ parse lại khi mtime đổi
+_cfg_cache = {"mtime": 0, "data": {}}
+
+def get_cfg() -> dict:
+    try:
+        m = CFG_FILE.stat().st_mtime_ns
+        if m != _cfg_cache["mtime"]:
+            _cfg_cache.update(mtime=m, data=yaml.safe_load(CFG_FILE.read_text()) or {})
+    except Exception:
+        pass
+    return _cfg_cache["data"]
+
+def read_state():
+    """State hiện tại, hoặc None nếu PLC đang ghi dở (shm) — gọi lại lần sau."""
     data = {
         "mode":"IDLE","total_done":0,"batch_count":0,"target_n":0,
         "error":"","ts":time.time(),"batch_size":10
     }
     try:
-        if STATE_FILE.exists():
-            data.update(json.loads(STATE_FILE.read_text()))
+        if SHM is not None:
+            st = SHM.read_state()
+            if st is None and SHM.state.seq:
+                return None  # không lấy được bản nhất quán; seq == 0: PLC chưa ghi lần nào
+            data.update(st or {})
+        elif STATE_FILE.exists():
+            data.update(json_loads(STATE_FILE.read_bytes()))
     except Exception as e:
         data["error"] = f"state read error: {e}"
     # Gửi kèm batch_size để hiển thị (đọc từ config nếu cần)
+    cfg = get_cfg()
+    if "batch_size" in cfg: data["batch_size"] = cfg["batch_size"]
+    return data
+
+def state_version():
+    """Thay đổi mỗi khi PLC ghi state (seq của shm, hoặc mtime của file).
+    None: PLC đang ghi dở (seq lẻ), chưa có version nào dùng được."""
+    if SHM is not None:
+        seq = SHM.state.seq
+        return None if seq & 1 else seq
     try:
-        import yaml
-        cfg = yaml.safe_load((BASE/"config.yaml").read_text())
-        if "batch_size" in cfg: data["batch_size"] = cfg["batch_size"]
-    except Exception:
-        pass
-    return jsonify(data)
+        return STATE_FILE.stat().st_mtime_ns
+    except OSError:
+        return 0
+
+# body /state đã encode sẵn, chỉ encode lại khi PLC ghi state mới hoặc config đổi
+_state_cache = {"key": None, "body": b""}
+
+@APP.route("/state")
+def state():
+    # Trả JSON cho JS đọc định kỳ (fallback khi browser không có EventSource)
+    get_cfg()
+    ver = state_version()
+    key = (ver, _cfg_cache["mtime"])
+    if ver is not None and key != _state_cache["key"]:
+        new = read_state()
+        if new is not None:
+            _state_cache.update(key=key, body=json_dumps(new))
+    if not _state_cache["body"]:
+        return Response(status=503)  # chưa có state nào đọc được; JS thử lại sau 1s
+    return Response(_state_cache["body"], mimetype="application/json")
+
+@APP.route("/events")
+def events():
+    # Server-Sent Events: mỗi client nhận full state lần đầu, sau đó chỉ các field
+    # đã đổi so với lần gửi trước (bỏ qua ts/seq), kèm seq tăng dần
+    def gen():
+        last_ver, last_sent, idle = None, {}, 0.0
+        while True:
+            ver = state_version()
+            new = read_state() if ver is not None and ver != last_ver else None
+            if new is not None:  # PLC ghi dở → không gửi, thử lại ở vòng sau
+                last_ver = ver
+                delta = {k: v for k, v in new.items()
+                         if k not in ("ts", "seq") and last_sent.get(k) != v}
+                if delta:
+                    delta["seq"] = ver
+                    last_sent.update(new)
+                    idle = 0.0
+                    yield b"data: " + json_dumps(delta) + b"\n\n"
+            if idle >= EVENT_KEEPALIVE_S:
+                idle = 0.0
+                yield b": keepalive\n\n"
+            _sleep(EVENT_POLL_S)
+            idle += EVENT_POLL_S
+    return Response(stream_with_context(gen()), mimetype="text/event-stream",
+                    headers={"X-Accel-Buffering": "no"})
+
+@APP.after_request
+def no_store_state(resp):
+    # state luôn là dữ liệu sống, không để browser/proxy cache
+    if request.path in ("/state", "/events"):
+        resp.headers["Cache-Control"] = "no-store"
+    return resp
 
 if __name__ == "__main__":
-    # Chạy dev server (debug), production dùng gunicorn
-    APP.run(host="0.0.0.0", port=5000)
+    # gevent: mỗi client (poll /state hoặc giữ /events) là một greenlet;
+    # không có gevent thì dùng dev server của Flask (threaded)
+    try:
+        from gevent.pywsgi import WSGIServer
+    except ImportError:
+        APP.run(host="0.0.0.0", port=5000, threaded=True)
+    else:
+        WSGIServer(("0.0.0.0", 5000), APP).serve_forever()
@@ -15,28 +15,63 @@ HMI (hmi.py) gửi lệnh:
   - {"reset": true}               : về IDLE, xóa đếm
   - {"calib": true}               : xung r_calib_req (nếu dùng), rồi về IDLE
 
+IPC với HMI: vùng nhớ chia sẻ /dev/shm/piplc_state (shm.py); chỉ khi máy không có
+/dev/shm mới dùng runtime_state.json / hmi_cmd.json. PLC chạy root (rt_priority, mlockall)
+còn HMI chạy user thường → đặt PIPLC_SHM_GROUP=<group của user HMI> cho cả hai service,
+nếu không bên mở sau sẽ dừng với lỗi PermissionError.
+
+Thư mục dữ liệu (config.yaml, runtime_state.json, ...): cạnh piplc.py, hoặc PIPLC_BASE.
+hmi.py dùng cùng quy tắc nên hai process luôn thấy cùng một thư mục.
+
 I/O mapping: xem cuối file (gợi ý cho config.yaml).
 
 Yêu cầu:
   - Đã cài driver HAT 4rel4in (Sequent)
   - PyYAML
+  - orjson (tuỳ chọn, nhanh hơn json của stdlib)
+  - smbus2 (tuỳ chọn, io_backend: i2c — đọc/ghi HAT trực tiếp không qua CLI)
+  - inotify_simple (tuỳ chọn, chỉ dùng khi fallback file: chờ hmi_cmd.json qua inotify)
+  - gpiod (tuỳ chọn, python3-libgpiod API v1; object_gpio: đếm object_signal theo event GPIO)
+  - rt_priority / cpu / mlockall trong config.yaml cần chạy bằng root (hoặc CAP_SYS_NICE,
+    CAP_IPC_LOCK); nên thêm isolcpus=<cpu> vào /boot/cmdline.txt để core đó chỉ chạy loop
 """
 
 import os
+import sys
 import time
+import ctypes
+import selectors
+from array import array
+from enum import IntEnum
 import json
+import logging
+import logging.handlers
 import signal
+import select
+import shlex
 import subprocess
 import shutil
 from pathlib import Path
 import yaml
+try:
+    from yaml import CSafeLoader as _YamlLoader   # libyaml (C), nhanh hơn nhiều
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from shm import open_region
 
 # ---------- tiện ích log ----------
-def log(msg: str):
-    print(f"[{time.strftime('%H:%M:%S')}] {msg}", flush=True)
+# cấu hình handler trong setup_logging() (main); import làm thư viện thì tuỳ bên gọi
+logger = logging.getLogger("piplc")
 
 # ---------- Paths ----------
-BASE = Path(__file__).resolve().parent.parent  # ~/piplc
+# Thư mục chung với hmi.py (config.yaml + file state/cmd/count).
+# Mặc định là thư mục chứa piplc.py; đổi bằng biến môi trường PIPLC_BASE.
+BASE = Path(os.environ.get("PIPLC_BASE", Path(__file__).resolve().parent)).resolve()
 CFG_FILE = BASE / "config.yaml"
 STATE_FILE = BASE / "runtime_state.json"
 CMD_FILE = BASE / "hmi_cmd.json"
@@ -48,40 +83,245 @@ class FourRel4In:
     def __init__(self, use_sudo=False, cmd_path=None):
         self.cmd = cmd_path or shutil.which("4rel4in") or "/usr/local/bin/4rel4in"
         self.use_sudo = bool(use_sudo)
+        # env + prefix không đổi giữa các lần gọi → tính một lần
+        self._env = {**os.environ, "PATH": os.environ.get("PATH", "") + ":/usr/local/bin"}
+        self._cmd_prefix = (["sudo", "-n"] if self.use_sudo else []) + [self.cmd]
+        # mỗi biến thể là một chuỗi format cho cả dòng lệnh → mỗi lần gọi chỉ một
+        # str.format; tham số toàn số/on/off nên split() ra argv là an toàn
         self._variants_read_in = [
-            ["{stack}", "inrd", "{ch}"],
+            "{stack} inrd {ch}",
         ]
         self._variants_set_relay = [
-            ["{stack}", "relwr", "{ch}", "{state}"],
+            "{stack} relwr {ch} {state}",
+        ]
+        # đọc cả 4 input một lần: "inrd" không kèm kênh trả về bitmask
+        self._variants_read_mask = [
+            "{stack} inrd",
         ]
+        # ghi cả 4 relay một lần: "relwr" chỉ kèm bitmask
+        self._variants_write_mask = [
+            "{stack} relwr {mask}",
+        ]
+        # biến thể chạy được lần đầu → dùng thẳng cho các lần sau
+        self._ok_read = None
+        self._ok_mask = None
+        self._ok_set = None
+        self._ok_wmask = None
+        # CLI không nhận relwr <mask> → ghi từng kênh, chỉ kênh khác lần ghi trước
+        self._wmask_supported = True
+        self._rel_written = [None] * 8
+        self.timeout_s = 0.2
+        # giữ một shell con thay vì fork+exec mỗi lần đọc/ghi
+        self.persistent = True
+        self._proc = None
+        self._buf = b""
+        self._fresh = False  # shell con vừa spawn, chưa chạy lệnh nào
+        self._END = b"__END__"
+
+    def _run(self, fmt:str, **kw) -> bytes:
+        line = fmt.format(**kw)
+        if self.persistent:
+            if self._proc is None or self._proc.poll() is not None:
+                try:
+                    self._spawn()
+                except OSError as e:
+                    # không spawn được shell con → quay về fork mỗi lần
+                    logger.warning("4rel4in coprocess unavailable (%s); falling back to per-call CLI", e)
+                    self.persistent = False
+            if self.persistent:
+                # lỗi pipe (BrokenPipeError...) → _run_coproc kill, lần sau spawn lại
+                return self._run_coproc(line)
+        # output chỉ là vài chữ số → giữ bytes, không decode/universal newlines
+        return subprocess.check_output(self._cmd_prefix + line.split(), env=self._env,
+                                       stdin=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                       timeout=self.timeout_s).strip()
 
-    def _run(self, args_fmt, **kw) -> str:
-        args = [s.format(**kw) for s in args_fmt]
-        cmd = [self.cmd] + args
+    # --- coprocess: 1 shell sống lâu, mỗi dòng stdin = 1 lần gọi 4rel4in ---
+    def _spawn(self):
+        # echo trống trước marker: output của CLI có thể không kết thúc bằng newline
+        script = (f"while read -r line; do {shlex.quote(self.cmd)} $line; rc=$?; "
+                  f"echo; echo \"{self._END.decode()} $rc\"; done")
+        cmd = ["bash", "-c", script]
         if self.use_sudo:
             cmd = ["sudo", "-n"] + cmd
-        env = os.environ.copy()
-        env["PATH"] = env.get("PATH", "") + ":/usr/local/bin"
-        return subprocess.check_output(cmd, text=True, env=env).strip()
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                      env=self._env, bufsize=0)
+        self._buf = b""
+        self._fresh = True
+        return self._proc
+
+    def _readline(self, deadline) -> bytes:
+        fd = self._proc.stdout.fileno()
+        while b"\n" not in self._buf:
+            left = deadline - time.monotonic()
+            if left <= 0 or not select.select([fd], [], [], left)[0]:
+                raise subprocess.TimeoutExpired(self.cmd, self.timeout_s)
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                raise RuntimeError("4rel4in coprocess exited")
+            self._buf += chunk
+        line, _, self._buf = self._buf.partition(b"\n")
+        return line
+
+    def _run_coproc(self, line:str) -> bytes:
+        timeout = self.timeout_s
+        if self._fresh:
+            self._fresh = False
+            timeout = max(timeout, 2.0)  # lần đầu còn tốn thời gian khởi động bash/sudo
+        deadline = time.monotonic() + timeout
+        lines = []
+        try:
+            self._proc.stdin.write((line + "\n").encode())
+            while True:
+                out = self._readline(deadline)
+                if out.startswith(self._END):
+                    rc = int(out[len(self._END):])
+                    break
+                lines.append(out)
+        except (subprocess.TimeoutExpired, RuntimeError, BrokenPipeError):
+            self.close()  # trạng thái pipe không còn tin được → spawn lại lần sau
+            raise
+        out = b"\n".join(lines).strip()
+        if rc != 0:
+            raise subprocess.CalledProcessError(rc, [self.cmd] + line.split(), out)
+        return out
 
-    def _try(self, variants, **kw):
+    def close(self):
+        p, self._proc = self._proc, None
+        if p is not None and p.poll() is None:
+            p.kill()
+            p.wait()
+
+    def _try(self, key, variants, **kw):
+        ok = getattr(self, key)
+        if ok is not None:
+            variants = [ok] + [v for v in variants if v is not ok]
         last = None
         for fmt in variants:
             try:
-                return self._run(fmt, **kw)
+                out = self._run(fmt, **kw)
             except Exception as e:
                 last = e
+                continue
+            setattr(self, key, fmt)
+            return out
         raise RuntimeError(f"4rel4in CLI not responding. Last: {last}")
 
     def read_in(self, stack:int, ch:int) -> int:
-        out = self._try(self._variants_read_in, stack=str(stack), ch=str(ch)).strip()
-        if out.endswith(("0","1")):
-            return int(out[-1])
+        out = self._try("_ok_read", self._variants_read_in, stack=str(stack), ch=str(ch))
+        if out and out[-1] in b"01":
+            return out[-1] - 0x30  # byte ASCII '0'/'1' → 0/1
         return int(out)
 
+    def read_in_mask(self, stack:int) -> int:
+        """Bitmask input của một stack (bit0 = IN1) trong một lần gọi CLI."""
+        out = self._try("_ok_mask", self._variants_read_mask, stack=str(stack))
+        return int(out.split()[-1])
+
     def set_relay(self, stack:int, ch:int, on:bool):
         state = "on" if on else "off"
-        _ = self._try(self._variants_set_relay, stack=str(stack), ch=str(ch), state=state)
+        _ = self._try("_ok_set", self._variants_set_relay, stack=str(stack), ch=str(ch), state=state)
+
+    def write_relays_mask(self, stack:int, mask:int):
+        """Ghi cả 4 relay của một stack (bit0 = REL1) trong một lần gọi CLI."""
+        if self._wmask_supported:
+            try:
+                self._try("_ok_wmask", self._variants_write_mask, stack=str(stack), mask=str(mask))
+                return
+            except RuntimeError:
+                if self._ok_wmask is not None:
+                    raise  # đã từng chạy được → lỗi I/O thật, không đổi cách ghi
+                logger.warning("4rel4in CLI does not accept a relay bitmask; writing relays per channel")
+                self._wmask_supported = False
+        prev = self._rel_written[stack]
+        for ch in range(1, 5):
+            bit = 1 << (ch - 1)
+            if prev is None or (prev ^ mask) & bit:
+                self.set_relay(stack, ch, bool(mask & bit))
+        self._rel_written[stack] = mask
+
+    @property
+    def has_mask(self) -> bool:
+        """CLI đã từng trả bitmask cho inrd → chắc chắn hỗ trợ."""
+        return self._ok_mask is not None
+
+# ---------- Direct I²C backend (smbus2) ----------
+# Register map card 4rel4in theo thư viện Python của Sequent (sm_4rel4in)
+I2C_BASE_ADDR = 0x0E        # + stack level (0..7)
+I2C_MEM_RELAY_VAL = 0x00    # bitmask 4 relay
+I2C_MEM_RELAY_SET = 0x01    # ghi số kênh (1..4) → bật relay
+I2C_MEM_RELAY_CLR = 0x02    # ghi số kênh (1..4) → tắt relay
+I2C_MEM_DIG_IN = 0x03       # bitmask 4 input opto (bit0 = IN1)
+
+class FourRel4InI2C:
+    """Cùng API với FourRel4In nhưng nói chuyện thẳng với HAT qua /dev/i2c-N:
+    mỗi lần đọc/ghi là một transaction I²C, không fork process."""
+    has_mask = True
+
+    def __init__(self, bus:int=1, stacks=()):
+        from smbus2 import SMBus
+        self.bus = SMBus(bus)
+        # SMBus() mở được cả khi không có card ở địa chỉ đó → đọc thử từng stack,
+        # lỗi thì raise OSError ngay để PiPLC chọn CLI thay vì lỗi ở mỗi tick
+        try:
+            for stack in stacks:
+                self.read_in_mask(stack)
+        except OSError:
+            self.bus.close()
+            raise
+
+    def read_in_mask(self, stack:int) -> int:
+        return self.bus.read_byte_data(I2C_BASE_ADDR + stack, I2C_MEM_DIG_IN)
+
+    def read_in(self, stack:int, ch:int) -> int:
+        return (self.read_in_mask(stack) >> (ch-1)) & 1
+
+    def set_relay(self, stack:int, ch:int, on:bool):
+        reg = I2C_MEM_RELAY_SET if on else I2C_MEM_RELAY_CLR
+        self.bus.write_byte_data(I2C_BASE_ADDR + stack, reg, ch)
+
+    def write_relays_mask(self, stack:int, mask:int):
+        self.bus.write_byte_data(I2C_BASE_ADDR + stack, I2C_MEM_RELAY_VAL, mask)
+
+    def close(self):
+        self.bus.close()
+
+# ---------- GPIO line events (libgpiod) ----------
+class GpioEdges:
+    """Một line GPIO của Pi đọc theo event: kernel xếp hàng từng cạnh kèm timestamp
+    nên không mất xung ngắn hơn một tick. Raise ImportError/OSError nếu không dùng được."""
+    def __init__(self, chip:str, offset:int, active_low:bool=True):
+        import gpiod
+        self.chip = gpiod.Chip(chip)
+        try:
+            self.line = self.chip.get_line(offset)
+            flags = gpiod.LINE_REQ_FLAG_BIAS_PULL_UP
+            if active_low:
+                flags |= gpiod.LINE_REQ_FLAG_ACTIVE_LOW
+            self.line.request(consumer="piplc", type=gpiod.LINE_REQ_EV_BOTH_EDGES, flags=flags)
+            self._rising = gpiod.LineEvent.RISING_EDGE
+        except AttributeError as e:
+            self.chip.close()
+            raise OSError(f"gpiod v1 API required ({e})")
+        except OSError:
+            self.chip.close()
+            raise
+        self.fd = self.line.event_get_fd()
+
+    def read(self):
+        """[(val, t_ms)] các cạnh đang chờ, không block. Timestamp là CLOCK_MONOTONIC
+        (kernel >= 5.7), cùng gốc với now_ms()."""
+        out = []
+        line = self.line
+        while line.event_wait(sec=0, nsec=0):
+            for ev in line.event_read_multiple():
+                out.append((1 if ev.type == self._rising else 0,
+                            ev.sec * 1000 + ev.nsec // 1_000_000))
+        return out
+
+    def close(self):
+        self.line.release()
+        self.chip.close()
 
 # ---------- helpers ----------
 def _stack_ch(spec, default_stack):
@@ -91,53 +331,180 @@ def _stack_ch(spec, default_stack):
         return int(spec.get("stack", default_stack)), int(spec["ch"])
     raise ValueError(f"Bad channel spec: {spec}")
 
+def _resolve_ch(spec, default_stack):
+    """spec → (stack, ch, bit) với bit = 1 << (ch-1) trong mask của stack."""
+    stack, ch = _stack_ch(spec, default_stack)
+    return stack, ch, 1 << (ch - 1)
+
 class OutputsLatch:
-    def __init__(self, driver: FourRel4In, default_stack:int):
+    """Nhớ trạng thái relay, mỗi stack một mask (bit ch-1 = relay ch, cùng layout
+    với thanh ghi relay của card). set() chỉ sửa mask; flush() ghi một lần cho mỗi
+    stack đã đổi. Kênh truyền vào là (stack, ch, bit) đã resolve sẵn bằng _resolve_ch."""
+    def __init__(self, driver: FourRel4In):
         self.drv = driver
-        self.default_stack = default_stack
-        self.state = {}  # (stack,ch)->bool
+        self.state_mask = [0] * 8   # giá trị mong muốn, theo stack 0..7
+        self._dirty_stacks = 0      # bit s = stack s cần ghi xuống card
+        self._synced = 0            # bit s = stack s đã ghi ít nhất một lần
 
-    def set(self, spec, val:bool):
-        stack, ch = _stack_ch(spec, self.default_stack)
-        key = (stack, ch)
-        if self.state.get(key) == bool(val):
+    def set(self, sc, val:bool):
+        stack, _, bit = sc
+        cur = self.state_mask[stack]
+        new = (cur | bit) if val else (cur & ~bit)
+        if new == cur and self._synced >> stack & 1:
             return
-        self.drv.set_relay(stack, ch, bool(val))
-        self.state[key] = bool(val)
+        self.state_mask[stack] = new
+        self._dirty_stacks |= 1 << stack
+
+    def toggle(self, sc):
+        """Đảo một relay (heartbeat): chỉ XOR bit, ghi cùng lần flush cuối tick."""
+        stack, _, bit = sc
+        self.state_mask[stack] ^= bit
+        self._dirty_stacks |= 1 << stack
+
+    def flush(self):
+        d = self._dirty_stacks
+        while d:
+            b = d & -d
+            s = b.bit_length() - 1
+            self.drv.write_relays_mask(s, self.state_mask[s])
+            # xoá dirty sau khi ghi được: lỗi I/O → stack vẫn dirty, lần flush sau ghi lại
+            self._dirty_stacks &= ~b
+            self._synced |= b
+            d ^= b
+
+def json_dumps(d, indent=False) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(d, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(d, indent=2 if indent else None).encode()
+
+def json_loads(b: bytes):
+    return orjson.loads(b) if orjson is not None else json.loads(b)
 
 def load_cfg():
-    return yaml.safe_load(CFG_FILE.read_text())
+    return yaml.load(CFG_FILE.read_bytes(), Loader=_YamlLoader)
+
+def _atomic_write(path: Path, payload: bytes, drop_cache: bool = False):
+    """Ghi file tạm rồi os.replace (atomic) bằng os.open/os.write, không qua file object.
+    drop_cache: bỏ trang khỏi page cache sau khi ghi (file không ai đọc thường xuyên)."""
+    tmp = path.with_suffix(".tmp")
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.write(fd, payload)
+        if drop_cache and hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+    os.replace(tmp, path)
 
 def save_state(d: dict):
-    tmp = STATE_FILE.with_suffix(".tmp")
-    tmp.write_text(json.dumps(d, indent=2))
-    os.replace(tmp, STATE_FILE)
+    # HMI đọc lại file này liên tục (fallback file) → giữ trong page cache
+    _atomic_write(STATE_FILE, json_dumps(d, indent=True))
 
 def load_count() -> int:
     try:
-        return int(json.loads(COUNT_FILE.read_text()).get("count", 0))
+        return int(json_loads(COUNT_FILE.read_bytes()).get("count", 0))
     except Exception:
         return 0
 
 def save_count(c: int):
-    tmp = COUNT_FILE.with_suffix(".tmp")
-    tmp.write_text(json.dumps({"count": c, "ts": time.time()}))
-    os.replace(tmp, COUNT_FILE)
+    # schema cố định 2 field → format thẳng, không qua json
+    _atomic_write(COUNT_FILE, b'{"count":%d,"ts":%f}' % (c, time.time()), drop_cache=True)
+
+_cmd_seen = None  # (st_ino, st_mtime_ns) của lệnh đã xử lý mà không xoá được file
 
 def read_cmd():
+    # đường thường gặp (không có lệnh) chỉ tốn một stat()
+    global _cmd_seen
     try:
-        d = json.loads(CMD_FILE.read_text())
-        try: os.remove(CMD_FILE)
-        except: pass
-        return d
-    except Exception:
+        st = os.stat(CMD_FILE)
+    except OSError:
         return None
+    key = (st.st_ino, st.st_mtime_ns)
+    if key == _cmd_seen:
+        return None  # lệnh này đã xử lý (xoá file thất bại)
+    try:
+        d = json_loads(CMD_FILE.read_bytes())
+    except Exception:
+        return None  # HMI đang ghi dở → tick sau đọc lại
+    # chỉ nhớ key khi file còn đó: mtime thô (1 jiffy) nên hai lệnh liên tiếp
+    # có thể trùng mtime, file mới không được bị coi là lệnh cũ
+    try:
+        os.remove(CMD_FILE)
+        _cmd_seen = None
+    except OSError:
+        _cmd_seen = key
+    return d
 
 def now_ms() -> int:
-    return int(time.time()*1000)
+    return time.monotonic_ns() // 1_000_000
+
+# ---------- timerfd (Linux) ----------
+class _timespec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+class _itimerspec(ctypes.Structure):
+    _fields_ = [("it_interval", _timespec), ("it_value", _timespec)]
+
+class TimerFD:
+    """Timer CLOCK_MONOTONIC tuần hoàn: fd đọc được mỗi period_ms, dùng được với selectors.
+    Raise OSError nếu hệ thống không có timerfd."""
+    CLOCK_MONOTONIC = 1
+    TFD_CLOEXEC = 0o2000000
+
+    def __init__(self, period_ms:int):
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            create, settime = libc.timerfd_create, libc.timerfd_settime
+        except (OSError, AttributeError) as e:
+            raise OSError(f"timerfd not available: {e}")
+        fd = create(self.CLOCK_MONOTONIC, self.TFD_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "timerfd_create failed")
+        sec, ms = divmod(int(period_ms), 1000)
+        ts = _timespec(sec, ms * 1_000_000)
+        if settime(fd, 0, ctypes.byref(_itimerspec(ts, ts)), None) < 0:
+            err = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(err, "timerfd_settime failed")
+        self.fd = fd
+
+    def read(self) -> int:
+        """Số chu kỳ đã hết hạn kể từ lần đọc trước (>1 nghĩa là bị trễ)."""
+        return int.from_bytes(os.read(self.fd, 8), sys.byteorder)
+
+    def close(self):
+        os.close(self.fd)
 
 # ---------- Main controller ----------
+class Mode(IntEnum):
+    """Giá trị = index trong PiPLC._handlers; .name là chuỗi ghi ra state/HMI."""
+    IDLE = 0
+    STARTING = 1
+    PICK_IN = 2
+    MARKING = 3
+    AFTER_MARK = 4
+    ERROR = 5
+
 class PiPLC:
+    IN_NAMES = ("btn_start", "ready_signal", "next_signal", "object_signal")
+    # không có __dict__: thêm attribute mới trong __init__ thì phải khai báo ở đây
+    __slots__ = (
+        "cfg", "loop_ms", "debounce_obj", "post_batch_timeout", "obj_timeout",
+        "batch_size", "target_n", "pulse_ms", "horn_ms",
+        "stack", "in_map", "out_map", "_in_resolved", "_out_resolved",
+        "drv", "rel", "shm", "_cmd_watch", "_cmd_pending",
+        "mode", "total_done", "batch_count", "target_set",
+        "_obj_raw", "_obj_candidate_ms", "_obj_stable", "_obj_pending", "_obj_gpio",
+        "_ready_last",
+        "_out_names", "_out_idx", "_out_sc", "_pulse_deadline", "_pulse_active",
+        "last_mode", "_handlers", "last_in", "last_out",
+        "_use_mask", "_in_stacks", "_in_bits", "_last_in_masks",
+        "hb_ms", "_hb_sc",
+        "_count_dirty", "_count_last_flush", "count_flush_ms",
+        "error", "_write_err", "_state_dirty", "_last_save_ms", "keepalive_ms",
+        "shutdown", "_tick_ms",
+    )
+
     def __init__(self):
         self.cfg = load_cfg()
 
@@ -155,262 +522,571 @@ class PiPLC:
         self.stack = int(self.cfg.get("stack_level", 0))
         self.in_map = self.cfg["inputs"]
         self.out_map = self.cfg["outputs"]
+        # resolve spec → (stack, ch, bit) một lần, hot path chỉ còn tra dict + unpack
+        self._in_resolved = {k: _resolve_ch(v, self.stack) for k, v in self.in_map.items()}
+        self._out_resolved = {k: _resolve_ch(v, self.stack) for k, v in self.out_map.items()}
 
         # Driver
+        # io_backend: cli (4rel4in) | i2c (smbus2, fallback về cli nếu không mở được
+        # bus hoặc card không trả lời)
         use_sudo = (os.getenv("PIPLC_USE_SUDO","0") == "1")
-        self.drv = FourRel4In(use_sudo=use_sudo)
-        self.rel = OutputsLatch(self.drv, self.stack)
+        self.drv = None
+        if str(self.cfg.get("io_backend", "cli")).lower() == "i2c":
+            stacks = {sc[0] for sc in self._in_resolved.values()} | {sc[0] for sc in self._out_resolved.values()}
+            try:
+                self.drv = FourRel4InI2C(int(self.cfg.get("i2c_bus", 1)), sorted(stacks))
+            except (ImportError, OSError) as e:
+                logger.warning("I2C backend unavailable (%s); using 4rel4in CLI", e)
+        if self.drv is None:
+            self.drv = FourRel4In(use_sudo=use_sudo)
+        self.rel = OutputsLatch(self.drv)
+
+        # IPC với HMI: /dev/shm; chỉ dùng file JSON khi máy không có /dev/shm (HMI cùng
+        # quy tắc). Mở không được vì quyền → raise, không chạy lệch kênh với HMI
+        self.shm = open_region()
+        if self.shm is None:
+            logger.warning("no /dev/shm; using JSON files for IPC")
+
+        # fallback file: chỉ đọc hmi_cmd.json khi inotify báo có ghi mới
+        self._cmd_watch = None
+        self._cmd_pending = True  # lệnh có thể đã nằm sẵn trước khi watch
+        if self.shm is None:
+            try:
+                from inotify_simple import INotify, flags
+                self._cmd_watch = INotify()
+                self._cmd_watch.add_watch(str(CMD_FILE.parent), flags.CLOSE_WRITE | flags.MOVED_TO)
+            except (ImportError, OSError) as e:
+                logger.warning("inotify unavailable (%s); polling %s", e, CMD_FILE.name)
+                self._cmd_watch = None
 
         # Runtime
-        self.mode = "IDLE"   # IDLE / STARTING / PICK_IN / MARKING / AFTER_MARK / ERROR
+        self.mode = Mode.IDLE
         self.total_done = 0
         self.batch_count = 0
         self.target_set = False
 
         # Edge & pulse
-        self.obj_last = 0
-        self.obj_last_edge_ms = 0
-        self._pulse_until = {}
+        # object_signal: chỉ nhận mức mới khi raw giữ nguyên >= debounce_obj ms
+        self._obj_raw = 0             # mẫu gần nhất
+        self._obj_candidate_ms = 0    # lúc raw đổi lần cuối
+        self._obj_stable = 0          # mức đã xác nhận
+        self._obj_pending = 0         # cạnh lên chưa xử lý; chỉ PICK_IN dùng, mode khác bỏ
+        # object_gpio: object_signal nối thẳng GPIO của Pi → đếm theo event thay vì IN4 của card
+        self._obj_gpio = None
+        if self.cfg.get("object_gpio") is not None:
+            try:
+                self._obj_gpio = GpioEdges(str(self.cfg.get("gpio_chip", "gpiochip0")),
+                                           int(self.cfg["object_gpio"]),
+                                           bool(self.cfg.get("object_gpio_active_low", True)))
+                logger.info("object_signal on GPIO %s (line events)", self.cfg["object_gpio"])
+            except (ImportError, OSError) as e:
+                logger.warning("GPIO events unavailable (%s); polling object_signal on the card", e)
+        # ready_signal ở tick trước: continue_signal chỉ pulse khi ready lên 0→1
+        self._ready_last = 0
+        # output theo slot (thứ tự out_map); pulse: 1 deadline / slot + bitmask slot đang chạy
+        self._out_names = tuple(self.out_map)
+        self._out_idx = {name: i for i, name in enumerate(self._out_names)}
+        self._out_sc = tuple(self._out_resolved[name] for name in self._out_names)
+        self._pulse_deadline = array("q", [0] * max(16, len(self._out_names)))
+        self._pulse_active = 0
 
         # logging trackers
         self.last_mode = self.mode
+        # state machine: handler theo thứ tự giá trị của Mode
+        self._handlers = (self._h_idle, self._h_starting, self._h_pick_in,
+                          self._h_marking, self._h_after_mark, self._h_error)
         self.last_in = {}
         self.last_out = {}
+        self._use_mask = True
+        # input của state machine: (vị trí stack trong _in_stacks, bit) theo thứ tự IN_NAMES
+        in_sc = [self._in_resolved[name] for name in self.IN_NAMES]
+        self._in_stacks = tuple(sorted({s for s, _, _ in in_sc}))
+        self._in_bits = tuple((self._in_stacks.index(s), bit) for s, _, bit in in_sc)
+        self._last_in_masks = None
 
         self.hb_ms = 0
+        self._hb_sc = self._out_resolved.get("pi_alive")  # None → không có heartbeat
+        # pick_counter.json: đếm trong RAM, ghi xuống khi đổi và cách lần trước ≥ 250 ms
+        self._count_dirty = False
+        self._count_last_flush = 0
+        self.count_flush_ms = 250
+        # runtime state: ghi khi dirty (đổi mode/bộ đếm/lệnh/lỗi) + keepalive 1 Hz
+        self.error = ""
+        self._write_err = ""  # lỗi flush relay gần nhất, "" khi đã ghi được
+        self._state_dirty = True
+        self._last_save_ms = 0
+        self.keepalive_ms = 1000
         self.shutdown = False
+        self._tick_ms = now_ms()  # cập nhật ở đầu mỗi tick
+
+        # realtime (tuỳ chọn): rt_priority, cpu, mlockall trong config.yaml
+        self._setup_realtime(self.cfg.get("rt_priority"), self.cfg.get("cpu"),
+                             bool(self.cfg.get("mlockall", False)))
+        # mọi giá trị cần dùng đã copy ra attribute → không giữ dict config lúc chạy
+        del self.cfg
+
+    def _setup_realtime(self, prio, cpu, lock_mem:bool):
+        """SCHED_FIFO + ghim CPU + mlockall cho process loop. Cần root/CAP_SYS_NICE
+        (và CAP_IPC_LOCK cho mlockall); thiếu quyền thì log rồi chạy tiếp như thường."""
+        if prio:
+            # RESET_ON_FORK: shell con của 4rel4in CLI quay về policy thường
+            policy = os.SCHED_FIFO | getattr(os, "SCHED_RESET_ON_FORK", 0)
+            try:
+                os.sched_setscheduler(0, policy, os.sched_param(int(prio)))
+                logger.info("RT: SCHED_FIFO priority %d", int(prio))
+            except (OSError, AttributeError) as e:
+                logger.warning("RT: SCHED_FIFO not set (%s)", e)
+        if cpu is not None:
+            try:
+                os.sched_setaffinity(0, {int(cpu)})
+                logger.info("RT: pinned to CPU %d", int(cpu))
+            except (OSError, AttributeError) as e:
+                logger.warning("RT: CPU affinity not set (%s)", e)
+        if lock_mem:
+            MCL_CURRENT, MCL_FUTURE = 1, 2
+            try:
+                libc = ctypes.CDLL(None, use_errno=True)
+                if libc.mlockall(MCL_CURRENT | MCL_FUTURE) != 0:
+                    raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+                logger.info("RT: memory locked (mlockall)")
+            except (OSError, AttributeError) as e:
+                logger.warning("RT: mlockall failed (%s)", e)
 
     # --- log state change ---
-    def _set_mode(self, new_mode: str, reason: str = ""):
+    def _set_mode(self, new_mode: Mode, reason: str = ""):
         if new_mode != self.mode:
-            log(f"STATE: {self.mode} → {new_mode}" + (f" | {reason}" if reason else ""))
+            logger.info("STATE: %s → %s%s", self.mode.name, new_mode.name, f" | {reason}" if reason else "")
+            self._flush_count(force=True)
+            self._state_dirty = True
             self.last_mode = self.mode
             self.mode = new_mode
+            if new_mode == Mode.PICK_IN:
+                self._ready_last = 0  # ready đang giữ 1 lúc vào PICK_IN vẫn được continue một lần
 
     # --- low-level I/O ---
     def _in(self, name) -> int:
-        spec = self.in_map[name]
-        s,ch = _stack_ch(spec, self.stack)
-        val = self.drv.read_in(s,ch)
-        # log on change
-        old = self.last_in.get(name, None)
-        if old is None or old != val:
-            log(f"IN  {name} = {val}")
-            self.last_in[name] = val
+        s, ch, _ = self._in_resolved[name]
+        val = self.drv.read_in(s, ch)
+        self._note_in(name, val)
         return val
 
+    def _note_in(self, name, val:int):
+        # log on change
+        last_in = self.last_in
+        if last_in.get(name) != val:
+            logger.info("IN  %s = %s", name, val)
+            last_in[name] = val
+
+    def _read_inputs(self):
+        """Snapshot các input của state machine: mỗi stack một lần đọc bitmask,
+        tách bit theo _in_bits. Driver không hỗ trợ bitmask → đọc từng kênh."""
+        names = self.IN_NAMES
+        if self._use_mask:
+            read_mask = self.drv.read_in_mask
+            try:
+                masks = [read_mask(s) for s in self._in_stacks]
+            except Exception as e:
+                if self.drv.has_mask:
+                    raise
+                logger.warning("inrd bitmask unsupported (%s); reading inputs one by one", e)
+                self._use_mask = False
+            else:
+                vals = [1 if masks[i] & bit else 0 for i, bit in self._in_bits]
+                # chỉ so từng input (để log) khi có bit nào đó đổi
+                if masks != self._last_in_masks:
+                    self._last_in_masks = masks
+                    for name, val in zip(names, vals):
+                        self._note_in(name, val)
+                return vals
+        return [self._in(name) for name in names]
+
     def _out(self, name, val:bool):
-        if name in self.out_map:
-            prev = self.last_out.get(name, None)
-            if prev is None or prev != bool(val):
-                log(f"OUT {name} = {'ON' if val else 'OFF'}")
-                self.last_out[name] = bool(val)
-            self.rel.set(self.out_map[name], val)
+        i = self._out_idx.get(name)
+        if i is not None:
+            self._out_i(i, val)
+
+    def _out_i(self, i:int, val:bool):
+        name = self._out_names[i]
+        if self.last_out.get(name) != bool(val):
+            logger.info("OUT %s = %s", name, "ON" if val else "OFF")
+            self.last_out[name] = bool(val)
+        self.rel.set(self._out_sc[i], val)
 
     def _pulse(self, name, dur_ms=None):
         if name not in self.out_map:
             return
         d = int(self.pulse_ms if dur_ms is None else dur_ms)
-        log(f"PULSE {name} ({d} ms)")
+        logger.info("PULSE %s (%d ms)", name, d)
         self._out(name, True)
-        self._pulse_until[name] = now_ms() + d
+        i = self._out_idx[name]
+        self._pulse_deadline[i] = self._tick_ms + d
+        self._pulse_active |= 1 << i
 
     def _service_pulses(self):
-        t = now_ms()
-        to_low = [k for k,until in self._pulse_until.items() if t >= until]
-        for k in to_low:
-            self._out(k, False)
-            del self._pulse_until[k]
+        active = self._pulse_active
+        if not active:
+            return
+        t = self._tick_ms
+        deadline = self._pulse_deadline
+        m = active
+        while m:
+            b = m & -m                # bit thấp nhất đang set
+            i = b.bit_length() - 1
+            if t >= deadline[i]:
+                self._out_i(i, False)
+                active ^= b
+            m ^= b
+        self._pulse_active = active
+
+    def _drain_cmd_watch(self):
+        if any(ev.name == CMD_FILE.name for ev in self._cmd_watch.read(timeout=0)):
+            self._cmd_pending = True
+
+    def _poll_cmd(self):
+        if self.shm is not None:
+            return self.shm.read_cmd()
+        if self._cmd_watch is not None:
+            # event inotify đã được loop drain trước tick
+            if not self._cmd_pending:
+                return None
+            self._cmd_pending = False
+        return read_cmd()
 
     def safe_outputs(self):
         for k in list(self.out_map.keys()):
             self._out(k, False)
-        self._pulse_until.clear()
+        self._pulse_active = 0
+        self._flush_outputs()
+
+    def _flush_outputs(self):
+        # lỗi ghi relay không được làm dừng loop: báo lỗi, stack còn dirty → tick sau ghi lại
+        try:
+            self.rel.flush()
+        except Exception as e:
+            self._write_err = f"IO write error: {e}"
+            self._set_error(self._write_err)
+            return
+        if self._write_err:
+            if self.error == self._write_err:
+                self._set_error("")
+            self._write_err = ""
 
     # --- helpers ---
-    def save_runtime(self, err:str=""):
+    def _flush_count(self, force:bool=False):
+        if not self._count_dirty:
+            return
+        t = self._tick_ms
+        if force or t - self._count_last_flush >= self.count_flush_ms:
+            save_count(self.total_done)
+            self._count_dirty = False
+            self._count_last_flush = t
+
+    def _set_error(self, msg:str):
+        if msg != self.error:
+            self.error = msg
+            self._state_dirty = True
+
+    def save_runtime(self):
+        self._state_dirty = False
+        self._last_save_ms = self._tick_ms
+        if self.shm is not None:
+            self.shm.write_state(self.mode.name, self.total_done, self.batch_count,
+                                 self.target_n, self.batch_size, self.error)
+            return
         save_state({
-            "mode": self.mode,
+            "mode": self.mode.name,
             "total_done": self.total_done,
             "batch_count": self.batch_count,
             "target_n": self.target_n,
-            "error": err,
+            "batch_size": self.batch_size,
+            "error": self.error,
             "ts": time.time()
         })
 
-    def edge_obj(self, val:int)->bool:
-        t = now_ms()
-        if val==1 and self.obj_last==0 and (t - self.obj_last_edge_ms) >= self.debounce_obj:
-            self.obj_last_edge_ms = t
-            self.obj_last = val
-            return True
-        self.obj_last = val
+    def edge_obj(self, val:int, t:int)->bool:
+        """Cạnh lên đã debounce: True khi mức 1 được giữ ổn định đủ debounce_obj ms.
+        t là thời điểm (ms, monotonic) của mẫu/event val."""
+        edge = False
+        if val != self._obj_raw:
+            # mức cũ có thể đã giữ đủ lâu tới lúc đổi (xung ngắn hơn 1 tick, đọc từ event)
+            edge = self._obj_confirm(t)
+            self._obj_raw = val
+            self._obj_candidate_ms = t   # raw đổi (kể cả rung) → đếm lại cửa sổ
+        return self._obj_confirm(t) or edge
+
+    def _obj_confirm(self, t:int)->bool:
+        raw = self._obj_raw
+        if raw != self._obj_stable and t - self._obj_candidate_ms >= self.debounce_obj:
+            self._obj_stable = raw
+            return raw == 1
         return False
 
+    def _drain_obj_events(self):
+        for val, t in self._obj_gpio.read():
+            if self.edge_obj(val, t):
+                self._obj_pending += 1
+
     def handle_cmd(self, cmd):
         if not cmd:
             return
+        self._state_dirty = True
         if cmd.get("reset"):
-            log("CMD reset")
-            self._set_mode("IDLE", "reset")
+            logger.info("CMD reset")
+            self._set_mode(Mode.IDLE, "reset")
             self.total_done = 0
             self.batch_count = 0
             self.target_set = False
             self.safe_outputs()
         if cmd.get("calib"):
-            log("CMD calib")
+            logger.info("CMD calib")
             if "r_calib_req" in self.out_map:
                 self._pulse("r_calib_req", self.pulse_ms)
-            self._set_mode("IDLE", "calib")
+            self._set_mode(Mode.IDLE, "calib")
         if cmd.get("auto"):
             t = int(cmd.get("target",0) or 0)
-            log(f"CMD auto target={t}")
+            logger.info("CMD auto target=%d", t)
             if t > 0:
                 self.target_n = t
                 self.total_done = 0
                 self.batch_count = 0
                 self.target_set = True
-                self._set_mode("STARTING", "auto command")
+                self._set_mode(Mode.STARTING, "auto command")
 
     # --- main loop ---
     def loop(self):
         self.safe_outputs()
         self.save_runtime()
-        log("PiPLC started. Mode=IDLE")
+        logger.info("PiPLC started. Mode=IDLE")
 
+        try:
+            timer = TimerFD(self.loop_ms)
+        except OSError as e:
+            logger.warning("%s; using sleep-based ticks", e)
+            self._loop_sleep()
+        else:
+            self._loop_select(timer)
+
+        # dừng do SIGINT/SIGTERM: không để mất số đếm / state chưa ghi
+        self._flush_count(force=True)
+        if self._state_dirty:
+            self.save_runtime()
+
+    def _loop_select(self, timer):
+        # kernel đánh thức khi tới tick (timerfd) hoặc khi HMI ghi lệnh (inotify)
+        sel = selectors.DefaultSelector()
+        sel.register(timer.fd, selectors.EVENT_READ, "tick")
+        if self._cmd_watch is not None:
+            sel.register(self._cmd_watch.fileno(), selectors.EVENT_READ, "cmd")
+        if self._obj_gpio is not None:
+            sel.register(self._obj_gpio.fd, selectors.EVENT_READ, "obj")
+        try:
+            while not self.shutdown:
+                for key, _ in sel.select():
+                    if key.data == "cmd":
+                        self._drain_cmd_watch()
+                    elif key.data == "obj":
+                        self._drain_obj_events()
+                    else:
+                        timer.read()  # trễ nhiều chu kỳ → vẫn chỉ chạy một tick, không chạy dồn
+                        # thứ tự key trong select() tuỳ ý: drain cạnh GPIO trước tick, nếu không
+                        # tick xác nhận _obj_raw cũ trong khi cạnh xuống còn nằm trong hàng đợi
+                        if self._obj_gpio is not None:
+                            self._drain_obj_events()
+                        self.tick()
+                        self._flush_outputs()
+                        self._flush_count()
+        finally:
+            sel.close()
+            timer.close()
+
+    def _loop_sleep(self):
+        # deadline theo monotonic: chu kỳ loop_ms không bị cộng thêm thời gian xử lý tick
+        period_ns = self.loop_ms * 1_000_000
+        next_tick = time.monotonic_ns()
         while not self.shutdown:
-            # heartbeat (optional)
-            if "pi_alive" in self.out_map and now_ms() - self.hb_ms > 500:
-                self.hb_ms = now_ms()
-                spec = self.out_map["pi_alive"]
-                s,ch = _stack_ch(spec, self.stack)
-                key = (s,ch)
-                cur = self.rel.state.get(key, False)
-                self.rel.set(spec, not cur)
-
-            # maintain pulses
-            self._service_pulses()
-
-            # read HMI command
-            cmd = read_cmd()
-            self.handle_cmd(cmd)
-
-            # read inputs (log done inside _in)
-            try:
-                btn_start = self._in("btn_start")
-                ready_sig = self._in("ready_signal")
-                next_sig  = self._in("next_signal")
-                obj_sig   = self._in("object_signal")
-                # nếu bạn có r_error trong inputs, thêm vào config.yaml rồi uncomment:
-                # err_sig   = self._in("r_error")
-                err_sig   = 0
-            except Exception as e:
-                self.save_runtime(err=f"IO read error: {e}")
-                time.sleep(self.loop_ms/1000.0)
-                continue
+            if self._cmd_watch is not None:
+                self._drain_cmd_watch()
+            if self._obj_gpio is not None:
+                self._drain_obj_events()
+            self.tick()
+            self._flush_outputs()
+            self._flush_count()
+            next_tick += period_ns
+            now = time.monotonic_ns()
+            dt = next_tick - now
+            if dt > 0:
+                time.sleep(dt / 1e9)
+            elif -dt > 5 * period_ns:
+                next_tick = now  # trễ quá 5 chu kỳ → bắt nhịp lại, không chạy dồn
+            # trễ ít hơn: chạy tick kế ngay để đuổi kịp, giữ nguyên pha
 
-            # robot error -> ERROR
-            if err_sig == 1:
-                self.safe_outputs()
-                self._set_mode("ERROR", "robot error input=1")
-                self.save_runtime(err="Robot error")
-                time.sleep(self.loop_ms/1000.0)
-                continue
+    def tick(self):
+        # một mốc thời gian cho cả tick; các helper đọc self._tick_ms
+        t = self._tick_ms = now_ms()
 
-            # ---- STATE MACHINE ----
-            if self.mode == "IDLE":
-                # chờ HMI auto(target) + BTN_START
-                self.batch_count = 0
-                if self.target_set and btn_start == 1:
-                    self._set_mode("STARTING", "target set + BTN_START=1")
-                self.save_runtime()
-                time.sleep(self.loop_ms/1000.0)
-                continue
+        # ghi state của tick trước nếu có thay đổi (hoặc keepalive cho HMI)
+        if self._state_dirty or t - self._last_save_ms >= self.keepalive_ms:
+            self.save_runtime()
 
-            if self.mode == "STARTING":
-                # Pulse Start_signal để robot move tới Ready
-                if "start_signal" in self.out_map:
-                    self._pulse("start_signal")
-                self.batch_count = 0
-                self._set_mode("PICK_IN", "start_signal pulsed")
-                self.save_runtime()
-                time.sleep(self.loop_ms/1000.0)
-                continue
+        # heartbeat (optional)
+        if self._hb_sc is not None and t - self.hb_ms > 500:
+            self.hb_ms = t
+            self.rel.toggle(self._hb_sc)
 
-            if self.mode == "PICK_IN":
-                # Đếm xung vật
-                if self.edge_obj(obj_sig):
-                    self.batch_count += 1
-                    self.total_done += 1
-                    save_count(self.total_done)
-                    log(f"OBJ_PULSE → batch_count={self.batch_count}, total_done={self.total_done}")
-
-                # Đủ target tổng?
-                if self.total_done >= self.target_n:
-                    if self.batch_count == 0:
-                        if "count_ok" in self.out_map:
-                            self._pulse("count_ok", self.pulse_ms)
-                            self._pulse("count_ok", self.horn_ms)
-                        self._set_mode("IDLE", "target total reached (no open batch)")
-                    else:
-                        if "over_signal" in self.out_map:
-                            self._pulse("over_signal")
-                        self._set_mode("MARKING", "target total reached; closing current batch")
-                    self.save_runtime()
-                    time.sleep(self.loop_ms/1000.0)
-                    continue
-
-                # Đủ 10 cho một lần marking?
-                if self.batch_count >= self.batch_size:
-                    if "over_signal" in self.out_map:
-                        self._pulse("over_signal")
-                    self._set_mode("MARKING", "batch_count reached batch_size")
-                    self.save_runtime()
-                    time.sleep(self.loop_ms/1000.0)
-                    continue
-
-                # Chưa đủ 10 & chưa đủ target -> chờ ready rồi continue
-                if ready_sig == 1:
-                    if "continue_signal" in self.out_map:
-                        self._pulse("continue_signal")
-                self.save_runtime()
-                time.sleep(self.loop_ms/1000.0)
-                continue
+        # maintain pulses
+        self._service_pulses()
 
-            if self.mode == "MARKING":
-                # Robot tự mark + pick-out; Pi chuyển sang AFTER_MARK để chờ next_signal
-                self._set_mode("AFTER_MARK", "waiting Next_signal")
-                self.save_runtime()
-                time.sleep(self.loop_ms/1000.0)
-                continue
+        # read HMI command
+        self.handle_cmd(self._poll_cmd())
 
-            if self.mode == "AFTER_MARK":
-                if next_sig == 1:
-                    if self.total_done >= self.target_n:
-                        if "count_ok" in self.out_map:
-                            self._pulse("count_ok", self.pulse_ms)
-                            self._pulse("count_ok", self.horn_ms)
-                        self.batch_count = 0
-                        self._set_mode("IDLE", "job completed")
-                    else:
-                        self.batch_count = 0
-                        self._set_mode("PICK_IN", "continue next batch")
-                    self.save_runtime()
-                time.sleep(self.loop_ms/1000.0)
-                continue
+        # read inputs (log done inside _read_inputs)
+        try:
+            btn_start, ready_sig, next_sig, obj_sig = self._read_inputs()
+            # nếu bạn có r_error trong inputs, thêm vào config.yaml rồi uncomment:
+            # err_sig   = self._in("r_error")
+            err_sig   = 0
+        except Exception as e:
+            self._set_error(f"IO read error: {e}")
+            return
+        if self.mode != Mode.ERROR:
+            self._set_error(self._write_err)  # lỗi ghi relay chỉ xoá khi flush ghi được
 
-            if self.mode == "ERROR":
-                self.save_runtime(err="ERROR state")
-                time.sleep(self.loop_ms/1000.0)
-                continue
+        # robot error -> ERROR
+        if err_sig == 1:
+            self.safe_outputs()
+            self._set_mode(Mode.ERROR, "robot error input=1")
+            self._set_error("Robot error")
+            return
+
+        # object_signal → số cạnh lên đã debounce (event GPIO: chỉ còn xác nhận mức đang giữ)
+        if self._obj_gpio is None:
+            self._obj_pending += self.edge_obj(obj_sig, t)
+        else:
+            self._obj_pending += self.edge_obj(self._obj_raw, t)
+
+        # ---- STATE MACHINE ----
+        # mỗi handler xử lý một mode, tự gọi _set_mode khi cần chuyển
+        self._handlers[self.mode](btn_start, ready_sig, next_sig, obj_sig)
+        self._obj_pending = 0  # PICK_IN đã dùng; mode khác: bỏ
+
+    def _h_idle(self, btn_start, ready_sig, next_sig, obj_sig):
+        # chờ HMI auto(target) + BTN_START
+        if self.batch_count:
+            self.batch_count = 0
+            self._state_dirty = True
+        if self.target_set and btn_start == 1:
+            self._set_mode(Mode.STARTING, "target set + BTN_START=1")
+
+    def _h_starting(self, btn_start, ready_sig, next_sig, obj_sig):
+        # Pulse Start_signal để robot move tới Ready
+        if "start_signal" in self.out_map:
+            self._pulse("start_signal")
+        self.batch_count = 0
+        self._set_mode(Mode.PICK_IN, "start_signal pulsed")
+
+    def _h_pick_in(self, btn_start, ready_sig, next_sig, obj_sig):
+        # Đếm xung vật
+        n = self._obj_pending
+        if n:
+            self.batch_count += n
+            self.total_done += n
+            self._count_dirty = True
+            self._state_dirty = True
+            logger.info("OBJ_PULSE → batch_count=%d, total_done=%d", self.batch_count, self.total_done)
+
+        # Đủ target tổng?
+        if self.total_done >= self.target_n:
+            if self.batch_count == 0:
+                if "count_ok" in self.out_map:
+                    self._pulse("count_ok", self.pulse_ms)
+                    self._pulse("count_ok", self.horn_ms)
+                self._set_mode(Mode.IDLE, "target total reached (no open batch)")
+            else:
+                if "over_signal" in self.out_map:
+                    self._pulse("over_signal")
+                self._set_mode(Mode.MARKING, "target total reached; closing current batch")
+            return
+
+        # Đủ 10 cho một lần marking?
+        if self.batch_count >= self.batch_size:
+            if "over_signal" in self.out_map:
+                self._pulse("over_signal")
+            self._set_mode(Mode.MARKING, "batch_count reached batch_size")
+            return
+
+        # Chưa đủ 10 & chưa đủ target -> mỗi lần ready lên 1 thì continue đúng một lần
+        if ready_sig == 1 and self._ready_last == 0:
+            if "continue_signal" in self.out_map:
+                self._pulse("continue_signal")
+        self._ready_last = ready_sig
+
+    def _h_marking(self, btn_start, ready_sig, next_sig, obj_sig):
+        # Robot tự mark + pick-out; Pi chuyển sang AFTER_MARK để chờ next_signal
+        self._set_mode(Mode.AFTER_MARK, "waiting Next_signal")
+
+    def _h_after_mark(self, btn_start, ready_sig, next_sig, obj_sig):
+        if next_sig == 1:
+            if self.total_done >= self.target_n:
+                if "count_ok" in self.out_map:
+                    self._pulse("count_ok", self.pulse_ms)
+                    self._pulse("count_ok", self.horn_ms)
+                self.batch_count = 0
+                self._set_mode(Mode.IDLE, "job completed")
+            else:
+                self.batch_count = 0
+                self._set_mode(Mode.PICK_IN, "continue next batch")
+
+    def _h_error(self, btn_start, ready_sig, next_sig, obj_sig):
+        # chờ HMI reset; lỗi đã ghi lúc vào ERROR
+        pass
 
 # ---------- Entrypoint ----------
+LOG_FILE = BASE / "piplc.log"
+
+class _BatchStreamHandler(logging.StreamHandler):
+    """emit() chỉ ghi vào bộ đệm stream, không flush từng dòng; xả bằng flush_batch()."""
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        logging.StreamHandler.flush(self)
+
+class _BatchFileHandler(_BatchStreamHandler, logging.FileHandler):
+    pass
+
+class _BatchMemoryHandler(logging.handlers.MemoryHandler):
+    """Đẩy cả lô record sang target rồi flush stream của target đúng một lần."""
+    def flush(self):
+        with self.lock:
+            super().flush()
+            if self.target is not None:
+                self.target.flush_batch()
+
+def setup_logging(level=logging.INFO):
+    """File log + stdout, cả hai gom theo lô: chỉ ghi/xả khi có WARNING trở lên, đầy
+    bộ đệm (50 dòng) hoặc lúc thoát, nên loop không flush/stat file từng dòng.
+    Không tự xoay vòng trong loop; xoay vòng bằng logrotate, ví dụ:
+        /path/to/piplc.log { size 1M  rotate 3  copytruncate  missingok }
+    (copytruncate: file mở O_APPEND nên không cần mở lại). SIGKILL có thể mất
+    tối đa một lô INFO chưa xả."""
+    fmt = logging.Formatter("[%(asctime)s] %(message)s", datefmt="%H:%M:%S")
+    logger.setLevel(level)
+    for target in (_BatchFileHandler(LOG_FILE), _BatchStreamHandler(sys.stdout)):
+        target.setFormatter(fmt)
+        logger.addHandler(_BatchMemoryHandler(capacity=50, flushLevel=logging.WARNING, target=target))
+
 def main():
+    setup_logging()
     plc = PiPLC()
     def _sig(*_): plc.shutdown = True
     signal.signal(signal.SIGINT, _sig)
     signal.signal(signal.SIGTERM, _sig)
-    plc.loop()
+    try:
+        plc.loop()
+    finally:
+        plc.drv.close()
+        if plc._obj_gpio is not None:
+            plc._obj_gpio.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+shm.py — vùng nhớ chia sẻ /dev/shm giữa piplc.py và hmi.py
+
+Thay cho runtime_state.json / hmi_cmd.json: hai process map cùng một file
+trên tmpfs và đọc/ghi tại chỗ, không JSON, không rename, không ghi SD.
+
+Layout cố định (4096 B):
+  STATE_OFF  StateBlk  — PLC ghi, HMI đọc
+  CMD_OFF    CmdBlk    — HMI ghi, PLC đọc
+
+Mỗi block dùng seqlock: writer đặt seq lẻ → ghi field → tăng lên chẵn;
+reader đọc lại nếu seq lẻ hoặc seq đổi trong lúc copy. Writer ép seq lẻ khi
+vào ((seq+1)|1) nên một writer chết giữa chừng (seq kẹt lẻ) không làm hỏng
+các lần ghi sau. Mỗi block chỉ một writer tại một thời điểm (HMI khoá write_cmd).
+
+Quyền: file tạo mới mode 0660 (CmdBlk điều khiển được robot → không để
+world-writable). PLC (root) và HMI (user thường) phải cùng group: đặt
+PIPLC_SHM_GROUP=<group> (vd. group chính của user chạy HMI) cho CẢ HAI process;
+process nào tạo file trước sẽ chown file về group đó.
+
+Hai bên phải dùng cùng một kênh: open_region() chỉ trả None (→ file JSON) khi máy
+không có /dev/shm; mở không được vì lý do khác (EACCES do sai group...) thì raise.
+"""
+
+import os
+import mmap
+import grp
+import time
+import ctypes
+
+SHM_PATH = "/dev/shm/piplc_state"
+SHM_SIZE = 4096
+SHM_MODE = 0o660
+STATE_OFF = 0
+CMD_OFF = 256
+
+class StateBlk(ctypes.Structure):
+    _fields_ = [
+        ("seq", ctypes.c_uint32),
+        ("mode", ctypes.c_char * 16),
+        ("total_done", ctypes.c_uint32),
+        ("batch_count", ctypes.c_uint32),
+        ("target_n", ctypes.c_uint32),
+        ("batch_size", ctypes.c_uint32),
+        ("ts", ctypes.c_double),
+        ("error", ctypes.c_char * 128),
+    ]
+
+class CmdBlk(ctypes.Structure):
+    _fields_ = [
+        ("seq", ctypes.c_uint32),
+        ("auto", ctypes.c_uint8),
+        ("reset", ctypes.c_uint8),
+        ("calib", ctypes.c_uint8),
+        ("target", ctypes.c_uint32),
+        ("ts", ctypes.c_double),
+    ]
+
+def _text(raw: bytes) -> str:
+    return raw.decode("utf-8", "replace")
+
+def open_region(path=SHM_PATH):
+    """ShmRegion, hoặc None nếu máy không có /dev/shm (cả PLC và HMI cùng dùng file JSON).
+    Lỗi khác raise: không để hai process âm thầm dùng hai kênh khác nhau."""
+    if not os.path.isdir(os.path.dirname(path)):
+        return None
+    try:
+        return ShmRegion(path)
+    except PermissionError as e:
+        raise PermissionError(e.errno, f"{e.strerror}: {path} (PLC và HMI phải cùng group, "
+                              f"đặt PIPLC_SHM_GROUP cho cả hai — xem shm.py)") from e
+
+class ShmRegion:
+    """Map SHM_PATH (tạo nếu chưa có). Raise OSError nếu không có /dev/shm."""
+    def __init__(self, path=SHM_PATH):
+        fd = self._open(path)
+        try:
+            if os.fstat(fd).st_size < SHM_SIZE:
+                os.ftruncate(fd, SHM_SIZE)
+            self.mm = mmap.mmap(fd, SHM_SIZE, mmap.MAP_SHARED,
+                                mmap.PROT_READ | mmap.PROT_WRITE)
+        finally:
+            os.close(fd)
+        self.state = StateBlk.from_buffer(self.mm, STATE_OFF)
+        self.cmd = CmdBlk.from_buffer(self.mm, CMD_OFF)
+        # bỏ qua lệnh cũ còn sót từ lần chạy trước
+        self._cmd_seen = self.cmd.seq
+
+    @staticmethod
+    def _open(path):
+        # mở file sẵn có KHÔNG kèm O_CREAT: với fs.protected_regular=1, O_CREAT trên
+        # file của user khác trong /dev/shm (sticky) bị EACCES kể cả khi là root
+        try:
+            return os.open(path, os.O_RDWR)
+        except FileNotFoundError:
+            pass
+        try:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, SHM_MODE)
+        except FileExistsError:
+            return os.open(path, os.O_RDWR)  # process kia vừa tạo trước
+        try:
+            os.fchmod(fd, SHM_MODE)  # không phụ thuộc umask
+            group = os.environ.get("PIPLC_SHM_GROUP")
+            if group:
+                os.fchown(fd, -1, grp.getgrnam(group).gr_gid)
+        except (OSError, KeyError) as e:
+            # để lại file sai group thì lần sau vẫn mở được nhưng bên kia không → xoá
+            os.close(fd)
+            os.unlink(path)
+            raise OSError(f"cannot set mode/group on {path}: {e}") from e
+        return fd
+
+    # --- StateBlk (PLC → HMI) ---
+    def write_state(self, mode:str, total_done:int, batch_count:int,
+                    target_n:int, batch_size:int, err:str=""):
+        s = self.state
+        s.seq = (s.seq + 1) | 1
+        s.mode = mode.encode()[:16]
+        s.total_done = total_done
+        s.batch_count = batch_count
+        s.target_n = target_n
+        s.batch_size = batch_size
+        s.error = err.encode("utf-8")[:128]
+        s.ts = time.time()
+        s.seq += 1
+
+    def read_state(self, retries:int=100):
+        """dict giống runtime_state.json, hoặc None nếu PLC chưa ghi lần nào."""
+        s = self.state
+        for _ in range(retries):
+            seq = s.seq
+            if seq & 1:
+                continue
+            d = {
+                "mode": _text(s.mode),
+                "total_done": s.total_done,
+                "batch_count": s.batch_count,
+                "target_n": s.target_n,
+                "batch_size": s.batch_size,
+                "error": _text(s.error),
+                "ts": s.ts,
+                "seq": seq,
+            }
+            if s.seq == seq:
+                return d if d["mode"] else None
+        return None
+
+    # --- CmdBlk (HMI → PLC) ---
+    def write_cmd(self, d: dict):
+        c = self.cmd
+        c.seq = (c.seq + 1) | 1
+        c.auto = 1 if d.get("auto") else 0
+        c.reset = 1 if d.get("reset") else 0
+        c.calib = 1 if d.get("calib") else 0
+        c.target = max(0, int(d.get("target", 0) or 0))
+        c.ts = time.time()
+        c.seq += 1
+
+    def read_cmd(self):
+        """Lệnh mới kể từ lần đọc trước, hoặc None."""
+        c = self.cmd
+        seq = c.seq
+        if seq == self._cmd_seen or seq & 1:
+            return None
+        d = {
+            "auto": bool(c.auto),
+            "reset": bool(c.reset),
+            "calib": bool(c.calib),
+            "target": c.target,
+            "ts": c.ts,
+        }
+        if c.seq != seq:
+            return None  # HMI đang ghi, đọc lại ở tick sau
+        self._cmd_seen = seq
+        return d